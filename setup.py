@@ -0,0 +1,19 @@
+'''
+编译可选的 Cython 内核（step/_kernels.pyx）：
+python setup.py build_ext --inplace
+未安装 Cython 时只安装纯 Python 的 step 包，step09.py 会使用 NumPy 实现
+'''
+from setuptools import Extension, setup
+
+try:
+    from Cython.Build import cythonize
+except ImportError: # Cython 是可选依赖
+    ext_modules = []
+else:
+    ext_modules = cythonize([Extension('step._kernels', ['step/_kernels.pyx'])])
+
+setup(
+    name='dezero',
+    packages=['step'],
+    ext_modules=ext_modules,
+)
@@ -23,4 +23,4 @@ class Function:
     
 class Square(Function):
     def forward(self, x):
-        return x ** 2
\ No newline at end of file
+        return x * x # 比 x ** 2（np.power）更快
\ No newline at end of file
@@ -16,23 +16,22 @@ def numerical_diff(f: Callable[[Variable], Variable], x: Variable, eps: float =
 
     Notes:
         - 该函数使用中心差分公式：(f(x + eps) - f(x - eps)) / (2 * eps)，以提高精度，相较前向差分误差更低。
+        - 两个扰动点被堆叠为一个数组后一次性传给 f，因此要求 f 按元素计算（如 square、exp）。
+        - 要求 f 返回的 Variable.data 是 np.ndarray（step09 的 Variable.__init__ 已保证这一点），差值直接在 data 上计算，不再用 np.array 额外复制。
         - 假设输入的 Variable.data 是标量。若需处理张量，需逐元素调用或扩展函数逻辑。
         - eps 值过小（如 1e-10）可能因浮点舍入误差导致结果不可靠，过大（如 0.1）则可能偏离真实导数。推荐范围为 1e-6 至 1e-3，默认为 1e-4。
         - 对于高曲率函数或噪声数据，数值导数可能不稳定，建议结合解析方法验证。
 
     Examples:
-        >>> x = Variable(2.0)
-        >>> f = lambda x: x ** 2
-        >>> numerical_diff(f, x)
-        4.000000000000051  # 近似 f'(x) = 2x 在 x = 2 处的值
+        >>> from step.step09 import Variable, square
+        >>> x = Variable(np.array(2.0))
+        >>> numerical_diff(square, x)
+        4.000000000004  # 近似 f'(x) = 2x 在 x = 2 处的值
     """
-    # 创建两个扰动后的 Variable 实例
-    x0 = Variable(x.data - eps)
-    x1 = Variable(x.data + eps)
-    
-    # 计算函数在扰动点的值
-    y0 = f(x0)
-    y1 = f(x1)
-    
-    # 将 memoryview 转换为 numpy array 进行计算
-    return float((np.array(y1.data) - np.array(y0.data)) / (2 * eps))
+    # 将两个扰动点堆叠为一个数组，只调用一次 f 即可同时得到 f(x - eps) 和 f(x + eps)
+    # 使用与 x 相同的 Variable 类，使 f 能访问该类额外的属性（如 step09 的 generation）
+    xb = type(x)(np.array([x.data - eps, x.data + eps]))
+    yb = f(xb)
+
+    # 使用 item() 取出标量，兼容形状为 (1,) 的输入
+    return (yb.data[1] - yb.data[0]).item() / (2 * eps)
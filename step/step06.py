@@ -14,6 +14,7 @@ class Function:
         self.input = input # 保存输入的变量
         # input 设置为实例变量，而不是局部变量，是为了在 backward 方法中使用
         # 如果设置为局部变量，则无法在 backward 方法中使用
+        self.output = output # 保存输出的变量，Exp 的 backward 会复用它
 
 
         return output
@@ -26,7 +27,7 @@ class Function:
     
 class Square(Function):
     def forward(self, x):
-        return x**2
+        return x * x # 用乘法代替 np.power，速度更快
     
     def backward(self, gy):
         '''
@@ -46,8 +47,9 @@ class Exp(Function):
         return np.exp(x)
     
     def backward(self, gy):
-        x = self.input.data
-        gx = np.exp(x) * gy
+        # exp(x) 的导数就是 exp(x) 本身，直接复用正向传播的输出 y，避免再算一次 np.exp
+        y = self.output.data
+        gx = y * gy
         
         return gx
     
@@ -37,7 +37,7 @@ class Function:
 
 class Square(Function):
     def forward(self, x):
-        return x**2
+        return x * x # 用乘法代替 np.power，速度更快
     
     def backward(self, gy):
         '''
@@ -57,8 +57,9 @@ class Exp(Function):
         return np.exp(x)
     
     def backward(self, gy):
-        x = self.input.data
-        gx = np.exp(x) * gy
+        # exp(x) 的导数就是 exp(x) 本身，直接复用正向传播的输出 y，避免再算一次 np.exp
+        y = self.output.data
+        gx = y * gy
         
         return gx
 
@@ -5,55 +5,229 @@
 3. 添加了y.grad = np.array(1.0)，使y的梯度为1
 4. 只支持ndarray类型，不支持标量类型
 '''
+from collections import OrderedDict
+
 import numpy as np
 
+try:
+    from numba import njit, prange
+except ImportError: # numba 是可选依赖，未安装时 Square/Exp 只使用 NumPy 计算
+    njit = None
+
+try:
+    from step._kernels import fast_square # 可选的 Cython 内核，需先执行 python setup.py build_ext --inplace
+except ImportError:
+    fast_square = None
+# 实测在小数组上 fast_square 的调用和数组整形开销反而比 x * x 大，只在较大的数组上使用
+_CYTHON_MIN_SIZE = 1 << 14
+
+_ENABLE_GRAD = [True] # 是否构建计算图，由 no_grad 切换
+
+# 浮点数据的默认类型，None 表示保留用户传入的类型
+# 设为 np.float32 后，大数组上受内存带宽限制的运算搬运的字节数减半；
+# 代价是精度下降，例如 eps=1e-4 的数值微分在 float32 下误差会明显变大
+DEFAULT_DTYPE = None
+
+
+class no_grad:
+    '''
+    在 with 块内关闭计算图的构建，适用于只做正向传播的推理场景：
+    输出变量不再记录创造者，函数也不再保存输入和输出，中间结果可以被及时回收
+    '''
+    def __enter__(self):
+        self.prev = _ENABLE_GRAD[0] # 保存进入前的状态，支持嵌套使用
+        _ENABLE_GRAD[0] = False
+        return self
+
+    def __exit__(self, *exc_info):
+        _ENABLE_GRAD[0] = self.prev
+
+
+def _readonly_one(dtype):
+    one = np.ones((), dtype=dtype)
+    one.flags.writeable = False # 被多个变量共享，设为只读，防止被原地修改
+    return one
+
+# 标量输出反向传播时的初始梯度，按 dtype 缓存，避免每次调用 backward 都分配一个 0 维数组
+_ONE_CACHE = {np.dtype(t): _readonly_one(t) for t in (np.float64, np.float32)}
+
+
+def _ones_grad(data):
+    '''
+    输出变量的初始梯度：0 维的常用浮点类型直接返回缓存，其余情况新建全 1 数组
+    '''
+    one = _ONE_CACHE.get(data.dtype) if data.ndim == 0 else None
+    return one if one is not None else np.ones_like(data)
+
+
+def _to_default_dtype(data):
+    '''
+    把浮点数组转换为 DEFAULT_DTYPE，整数、布尔等其他类型保持不变
+    '''
+    if data.dtype.kind == 'f' and data.dtype != DEFAULT_DTYPE:
+        return data.astype(DEFAULT_DTYPE)
+    return data
+
 class Variable:
+    __slots__ = ('data', 'grad', 'creator', '_version') # 用 __slots__ 代替实例 __dict__，减少内存分配并加快属性访问
+
     def __init__(self, data):
         if data is not None:
-            if not isinstance(data, np.ndarray):
+            if type(data) is not np.ndarray: # 比 isinstance 更快
                 raise TypeError(f"{type(data)} is not supported")
+            if DEFAULT_DTYPE is not None:
+                data = _to_default_dtype(data)
         self.data = data
         self.grad = None
         self.creator = None
+        self._version = 0 # 每次写入 grad 时加 1，用于使 Function 的缓存失效
 
     def sef_creator(self, func):
         self.creator = func
 
-    def backward(self):
+    def backward(self, retain_grad=False):
+        '''
+        沿链传递的是本次反向传播中流过的梯度，而不是变量上已累加的 grad，
+        所以对共享同一中间变量的多个输出分别调用 backward 时，梯度不会被重复计入
+        默认只有叶子变量（creator 为 None）保存梯度；retain_grad=True 时中间变量也累加保存
+        self.grad 不为 None 时直接用作初始梯度（例如 Segment 传入的上游梯度）
+        0 维 float64/float32 输出的初始梯度是各变量共享的只读数组，不能原地修改 self.grad（如 y.grad += 1），需要时先复制
+        '''
         if self.grad is None:  # 如果梯度为None，初始化为1
-            self.grad = np.ones_like(self.data)
-
-        funcs = [self.creator]
-        while funcs:
-            f = funcs.pop() # 获取最后一个元素
-            x, y = f.input, f.output # 获取输入和输出
-            x.grad = f.backward(y.grad) # 计算梯度
-
-            if x.creator is not None:
-                funcs.append(x.creator) # 将输入的创造者添加到列表中
+            self.grad = _ones_grad(self.data)
+            self._version += 1
 
+        # 这里的函数都只有一个输入，从 self 沿 creator 向前只有一条链，链本身就是反向传播的顺序（tape），
+        # 它由计算图中的变量持有，随计算图一起释放，不需要全局记录，也不需要搜索或排序
+        gy = self.grad
+        f = self.creator
+        while f is not None:
+            x = f.input
+            gx = f.backward(gy) # 计算梯度
+            if retain_grad or x.creator is None:
+                if x.grad is None:
+                    # backward 若直接返回 gy，先复制一份，避免之后的原地累加改写 y.grad
+                    x.grad = gx.copy() if gx is gy else gx
+                elif (type(x.grad) is np.ndarray and x.grad.shape == np.shape(gx) and x.grad.flags.writeable
+                      and np.result_type(x.grad, gx) == x.grad.dtype):
+                    np.add(x.grad, gx, out=x.grad) # 同一变量被多次使用时原地累加梯度，不分配新数组
+                else: # 需要广播、x.grad 是只读的缓存数组，或相加后类型会提升（如整数加浮点）时，只能创建新数组
+                    x.grad = x.grad + gx
+                x._version += 1
+            gy = gx
+            f = x.creator
 
 def as_array(x):
     '''
     将输入转换为ndarray类型
+    不使用 np.isscalar（内部要做多次 isinstance 检查，较慢），ndarray 原样返回，其余交给 np.asarray
     '''
-    if np.isscalar(x):
-        return np.array(x)
-    return x
+    return x if type(x) is np.ndarray else np.asarray(x)
+
+
+# 大数组上的逐元素运算受内存带宽限制，NumPy 表达式 2 * x * gy 会分配临时数组并多次遍历内存，
+# 用 numba 把整个表达式融合成一次遍历；各 dtype 的版本由 njit 在首次调用时分别编译并缓存
+_NUMBA_MIN_SIZE = 1 << 16 # 数组较小时并行调度的开销大于收益，仍使用 NumPy
+_NUMBA_DTYPES = (np.dtype(np.float32), np.dtype(np.float64)) # float16、longdouble 等类型 numba 不支持或精度不同，交给 NumPy
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _square_fwd(x, out):
+        for i in prange(x.size):
+            out[i] = x[i] * x[i]
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _square_bwd(x, gy, out):
+        for i in prange(x.size):
+            out[i] = 2 * x[i] * gy[i]
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _exp_bwd(y, gy, out):
+        for i in prange(y.size):
+            out[i] = y[i] * gy[i]
+
+
+def _use_numba(x, *others):
+    '''
+    判断是否使用 numba 内核：x 是足够大的 float32/float64 数组，
+    且其余参数是与 x 同形同 dtype 的 ndarray（不处理广播）
+    调用方先检查 njit is not None，未安装 numba 时不必进入本函数
+    '''
+    if x.size < _NUMBA_MIN_SIZE or x.dtype not in _NUMBA_DTYPES:
+        return False
+    for a in others:
+        if type(a) is not np.ndarray or a.shape != x.shape or a.dtype != x.dtype:
+            return False
+    return True
+
+
+def _run_kernel(kernel, *arrays):
+    '''
+    在展平后的连续内存上调用 numba 内核，返回与第一个参数同形的新数组
+    '''
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    out = np.empty_like(arrays[0])
+    kernel(*[a.reshape(-1) for a in arrays], out.reshape(-1))
+    return out
 
 class Function:
+    __slots__ = ('input', 'output')
+
+    # 记忆化：设为 True 后（可对 Function 全局开启，也可只对某个子类开启），
+    # 同一个输入变量在 data 未被替换、grad 未被写入的情况下再次调用同类、同参数的函数时，直接返回缓存的输出
+    # 只有 _memo_key 不返回 None 的函数参与记忆化；注意：对 data 的原地修改（如 x.data += 1）无法被检测到
+    memoize = False
+    _cache = OrderedDict() # 所有子类共享，键为 (函数类型, _memo_key(), id(输入), 输入的 _version)
+    _cache_size = 1024 # 超出后按 LRU 淘汰最久未使用的条目
+
     def __call__(self, input):
         x = input.data
+        enable_grad = _ENABLE_GRAD[0]
+        memoize = enable_grad and self.memoize # 不构建计算图时得到的输出没有创造者，不能放入缓存
+        if memoize:
+            params = self._memo_key()
+            memoize = params is not None
+        if memoize:
+            key = (type(self), params, id(input), input._version)
+            entry = Function._cache.get(key)
+            # 缓存的输出通过 creator 持有原输入变量，因此 id 在条目存活期间不会被复用
+            if entry is not None and entry[0] is x:
+                Function._cache.move_to_end(key)
+                return entry[1]
+
         y = self.forward(x) # 正向传播
-        output = Variable(as_array(y)) # 创建输出变量
-        output.sef_creator(self) # 让输出变量保存创造者信息，即当前函数
-        self.input = input # 保存输入变量
-        self.output = output # 保存输出变量
+        output = Variable(y if type(y) is np.ndarray else np.asarray(y)) # 创建输出变量（内联 as_array 以省去 np.isscalar）
+        if enable_grad:
+            output.creator = self # 让输出变量保存创造者信息，即当前函数（直接赋值，省去调用 sef_creator 的开销）
+            self.input = input # 保存输入变量
+            self.output = output # 保存输出变量
+
+        if memoize:
+            Function._cache[key] = (x, output)
+            if len(Function._cache) > Function._cache_size:
+                Function._cache.popitem(last=False)
         return output
 
+    def _memo_key(self):
+        '''
+        记忆化时区分同类函数不同实例的参数，返回 None 表示不参与记忆化
+        默认返回 None，因为子类可能带有实例参数，不能只凭类型共用缓存；
+        无状态的函数返回 ()，带参数的函数返回由参数组成的可哈希元组
+        '''
+        return None
+
 class Square(Function):
+    __slots__ = () # 子类也需声明 __slots__，否则仍会创建 __dict__
+
+    def _memo_key(self):
+        return () # 没有实例参数，同类实例可以共用缓存
+
     def forward(self, x):
-        return x**2
+        if njit is not None and _use_numba(x):
+            return _run_kernel(_square_fwd, x)
+        if fast_square is not None and x.dtype == np.float64 and x.size >= _CYTHON_MIN_SIZE:
+            return fast_square(x)
+        return x * x # x ** 2 会调用通用的 np.power，乘法要快得多
     
     def backward(self, gy):
         '''
@@ -63,6 +237,8 @@ class Square(Function):
         3. 返回结果
         '''
         x = self.input.data
+        if njit is not None and _use_numba(x, gy):
+            return _run_kernel(_square_bwd, x, gy)
         gx = 2 * x * gy
 
         return gx
@@ -71,19 +247,160 @@ def square(x):
     return Square()(x)
 
 class Exp(Function):
+    __slots__ = ()
+
+    def _memo_key(self):
+        return ()
+
     def forward(self, x):
 
         return np.exp(x)
     
     def backward(self, gy):
-        x = self.input.data
-        gx = np.exp(x) * gy
+        # exp(x) 的导数就是 exp(x) 本身，直接复用正向传播的输出 y，避免再算一次 np.exp
+        y = self.output.data
+        if njit is not None and _use_numba(y, gy):
+            return _run_kernel(_exp_bwd, y, gy)
+        gx = y * gy
         
         return gx
 
 def exp(x):
     return Exp()(x)
 
+class FusedSquareExpSquare(Function):
+    '''
+    square(exp(square(x))) = (exp(x^2))^2 = exp(2x^2) 的融合版本
+    原本正向、反向各需要三个函数、多个临时数组，融合后各只需一个表达式
+    '''
+    __slots__ = ()
+
+    def _memo_key(self):
+        return ()
+
+    def forward(self, x):
+        return np.exp(2 * x * x)
+
+    def backward(self, gy):
+        # d/dx exp(2x^2) = 4x * exp(2x^2)，其中 exp(2x^2) 就是正向传播的输出
+        x = self.input.data
+        y = self.output.data
+        return 4 * x * y * gy
+
+def optimize(output):
+    '''
+    改写计算图：沿 output 的创造者链向前查找 square(exp(square(x))) 的模式，
+    并替换为一个 FusedSquareExpSquare 节点，之后的反向传播只需经过融合后的节点
+    被替换掉的中间变量不再属于计算图，反向传播时也不会得到梯度
+    返回 output 本身
+    '''
+    v = output
+    while v.creator is not None:
+        f3 = v.creator
+        f2 = f3.input.creator
+        f1 = f2.input.creator if isinstance(f2, Exp) else None
+        if isinstance(f3, Square) and isinstance(f2, Exp) and isinstance(f1, Square):
+            x = f1.input
+            fused = FusedSquareExpSquare()
+            fused.input = x
+            fused.output = v
+            v.sef_creator(fused) # 把融合节点接入计算图，v 的数据不变
+            v = x
+        else:
+            v = f3.input
+    return output
+
+class Segment(Function):
+    '''
+    检查点（重计算）：把连续的若干个单输入单输出函数合并为一段
+    正向传播时在 no_grad 下依次计算，只保留这一段的输入（端点）和输出，不保存段内的中间结果；
+    反向传播时从保存的输入重新执行一遍正向传播，构建局部计算图求出梯度
+    把长度为 N 的链每 √N 个函数分为一段，需要保存的中间结果就从 O(N) 降为 O(√N)
+    '''
+    __slots__ = ('funcs',) # funcs 不同的 Segment 属于同一类型，沿用默认的 _memo_key，不参与记忆化
+
+    def __init__(self, funcs):
+        self.funcs = funcs # 接受并返回 Variable 的可调用对象，如 square、exp
+
+    def forward(self, x):
+        with no_grad():
+            v = Variable(x)
+            for f in self.funcs:
+                v = f(v)
+        return v.data
+
+    def backward(self, gy):
+        x = Variable(self.input.data)
+        y = x
+        prev = _ENABLE_GRAD[0] # backward 可能在 no_grad 块内调用，重计算时仍需构建局部计算图
+        _ENABLE_GRAD[0] = True
+        try:
+            for f in self.funcs: # 重新计算段内的中间结果
+                y = f(y)
+        finally:
+            _ENABLE_GRAD[0] = prev
+        y.grad = gy
+        y.backward() # 重计算产生的局部计算图只由 x、y 持有，返回后即可被回收
+        return x.grad
+
+def checkpoint(*funcs):
+    '''
+    把 funcs 包装为一个检查点段，返回的函数用法与 square、exp 相同，例如：
+    y = checkpoint(exp, square)(checkpoint(exp, square)(x)) # 等价于 square(exp(square(exp(x))))
+    '''
+    def f(x):
+        return Segment(funcs)(x)
+    return f
+
+def _as_input(x):
+    '''
+    compile_grad 生成的 run 对输入的处理，与 Variable.__init__ 一致：只接受 ndarray，并转换为 DEFAULT_DTYPE
+    '''
+    if type(x) is not np.ndarray:
+        raise TypeError(f"{type(x)} is not supported")
+    return x if DEFAULT_DTYPE is None else _to_default_dtype(x)
+
+def compile_grad(f, x0):
+    '''
+    tape 回放：用 x0 运行一次 f，沿输出的 creator 链取出从 x0 到输出依次调用的函数，生成一段直线式的程序，
+    返回 run(x)：输入 ndarray，返回 (f(x) 的值, f 对 x 的梯度)
+    之后每次调用 run 只依次调用各函数的 forward/backward，不再创建 Variable、不再遍历计算图
+    要求计算图的结构不随 x 的值变化；run 会改写记录下来的变量的 data，不能同时在多处调用
+    记录在 x0 的私有副本上进行，调用方的 x0 不会被 run 改写
+    '''
+    x0 = Variable(x0.data.copy())
+    y = f(x0)
+    funcs = []
+    v = y
+    while v is not x0:
+        fn = v.creator
+        if fn is None:
+            raise RuntimeError("the output of f is not connected to x0 by a recorded graph (is no_grad on?)")
+        funcs.append(fn)
+        v = fn.input
+    funcs.reverse() # creator 链是从输出到 x0 的顺序，正向传播需要反过来
+
+    # 第 k 个函数的输入是 v{k}，输出是 v{k+1}；v0 就是 x
+    env = {'as_array': as_array, '_ones_grad': _ones_grad, '_as_input': _as_input}
+    lines = ['def run(x):', '    v0 = _as_input(x)']
+    for k, fn in enumerate(funcs):
+        env[f'F{k}'], env[f'B{k}'] = fn.forward, fn.backward
+        env[f'I{k}'], env[f'O{k}'] = fn.input, fn.output
+        lines.append(f'    v{k + 1} = as_array(F{k}(v{k}))')
+
+    # backward 需要读取 self.input.data / self.output.data，先把它们指向本次计算的结果
+    for k in range(len(funcs)):
+        lines.append(f'    I{k}.data = v{k}; O{k}.data = v{k + 1}')
+
+    n = len(funcs)
+    lines.append(f'    g{n} = _ones_grad(v{n})')
+    for k in reversed(range(n)):
+        lines.append(f'    g{k} = B{k}(g{k + 1})')
+    lines.append(f'    return v{n}, g0')
+
+    exec('\n'.join(lines), env)
+    return env['run']
+
 # # 测试
 # x = Variable(np.array(1.0))
 # y = square(exp(x))
@@ -4,17 +4,20 @@
 
 import unittest
 import numpy as np
+from step import step09, step11
 from step.step04 import numerical_diff
-from step.step09 import Variable, Square, Exp, square, exp
+from step.step09 import Variable, Function, Square, Exp, square, exp, no_grad, checkpoint, optimize, FusedSquareExpSquare, compile_grad
 
 
 # 测试 square() 函数的正向/反向传播功能
 class SquareTest(unittest.TestCase):
     def test_forward(self):
         x = Variable(np.array(2.0))
-        y = square(x)
+        with no_grad(): # 只测试正向传播，不需要构建计算图
+            y = square(x)
         expected = np.array(4.0)
         self.assertEqual(y.data, expected)
+        self.assertIsNone(y.creator)
 
     def test_backward(self):
         x = Variable(np.array(3.0))
@@ -36,9 +39,11 @@ class SquareTest(unittest.TestCase):
 class ExpTest(unittest.TestCase):
     def test_forward(self):
         x = Variable(np.array(2.0))
-        y = exp(x)
+        with no_grad():
+            y = exp(x)
         expected = np.exp(2)
         self.assertEqual(y.data, expected)
+        self.assertIsNone(y.creator)
 
     def test_backward(self):
         x = Variable(np.array(2.0))
@@ -54,4 +59,332 @@ class ExpTest(unittest.TestCase):
         y.backward()
         num_grad = numerical_diff(exp, x)
         flg = np.allclose(x.grad, num_grad)
-        self.assertTrue(flg)
\ No newline at end of file
+        self.assertTrue(flg)
+
+# 测试检查点：重计算得到的梯度应与直接反向传播一致
+class CheckpointTest(unittest.TestCase):
+    def test_backward(self):
+        x0 = Variable(np.random.rand(3))
+        y0 = square(exp(square(exp(x0))))
+        y0.backward()
+
+        x1 = Variable(x0.data.copy())
+        y1 = checkpoint(exp, square)(checkpoint(exp, square)(x1))
+        y1.backward()
+        self.assertTrue(np.allclose(y1.data, y0.data))
+        self.assertTrue(np.allclose(x1.grad, x0.grad))
+
+    def test_backward_no_grad(self):
+        # 在 no_grad 块内反向传播时，重计算仍要构建局部计算图
+        x0 = Variable(np.array(1.0))
+        square(exp(x0)).backward()
+
+        x1 = Variable(np.array(1.0))
+        y1 = checkpoint(exp, square)(x1)
+        with no_grad():
+            y1.backward()
+        self.assertTrue(np.allclose(x1.grad, x0.grad))
+
+        run = compile_grad(checkpoint(exp, square), Variable(np.array(1.0)))
+        with no_grad():
+            _, gx = run(np.array(1.0))
+        self.assertTrue(np.allclose(gx, x0.grad))
+
+# 测试计算图改写：融合后的梯度应与原计算图一致
+class OptimizeTest(unittest.TestCase):
+    def test_fuse(self):
+        x = Variable(np.random.rand(3))
+        y = optimize(square(exp(square(x))))
+        self.assertIsInstance(y.creator, FusedSquareExpSquare)
+        self.assertIs(y.creator.input, x)
+        y.backward()
+        expected = 4 * x.data * np.exp(2 * x.data ** 2)
+        self.assertTrue(np.allclose(x.grad, expected))
+
+# 测试 tape 回放：编译后的程序应与直接反向传播的结果一致
+class CompileGradTest(unittest.TestCase):
+    def test_replay(self):
+        f = lambda x: square(exp(square(x)))
+        run = compile_grad(f, Variable(np.array(0.5)))
+        for value in (0.5, 1.5):
+            x = Variable(np.array(value))
+            y = f(x)
+            y.backward()
+            y_data, gx = run(np.array(value))
+            self.assertTrue(np.allclose(y_data, y.data))
+            self.assertTrue(np.allclose(gx, x.grad))
+
+    def test_private_input(self):
+        x0 = Variable(np.array(0.5))
+        run = compile_grad(lambda x: exp(square(x)), x0)
+        run(np.array(1.5))
+        self.assertEqual(x0.data, 0.5) # run 不能改写调用方的 x0
+        with self.assertRaises(TypeError):
+            run(1.5)
+
+# 测试共享中间变量：对两个输出分别调用 backward，叶子变量的梯度应为两者之和，不能重复计入中间变量上留下的梯度
+class SharedIntermediateTest(unittest.TestCase):
+    def expected(self, x):
+        a = np.exp(x)
+        return 2 * a * a + np.exp(a) * a # d(a^2)/dx + d(exp(a))/dx, a = exp(x)
+
+    def test_separate_backward(self):
+        x = Variable(np.array(0.5))
+        a = exp(x)
+        b = square(a)
+        c = exp(a)
+        b.backward()
+        c.backward()
+        self.assertTrue(np.allclose(x.grad, self.expected(x.data)))
+        self.assertIsNone(a.grad)
+
+    def test_retain_grad(self):
+        x = Variable(np.array(0.5))
+        a = exp(x)
+        b = square(a)
+        c = exp(a)
+        b.backward(retain_grad=True)
+        c.backward(retain_grad=True)
+        self.assertTrue(np.allclose(x.grad, self.expected(x.data)))
+        self.assertTrue(np.allclose(a.grad, 2 * a.data + np.exp(a.data)))
+
+# 测试梯度累加：原地累加不能改写上游梯度，类型提升时要创建新数组
+class AccumulateTest(unittest.TestCase):
+    def test_alias_copy(self):
+        class Identity(Function):
+            __slots__ = ()
+
+            def forward(self, x):
+                return x
+
+            def backward(self, gy):
+                return gy # 原样返回上游梯度
+
+        x = Variable(np.array([1.0, 2.0]))
+        y = Identity()(x)
+        y.backward()
+        self.assertIsNot(x.grad, y.grad)
+        y.backward() # 第二次累加在 x.grad 上原地进行，y.grad 应保持不变
+        self.assertTrue(np.array_equal(x.grad, [2.0, 2.0]))
+        self.assertTrue(np.array_equal(y.grad, [1.0, 1.0]))
+
+    def test_int_to_float(self):
+        x = Variable(np.array([3]))
+        square(x).backward()
+        self.assertEqual(x.grad.dtype.kind, 'i')
+        exp(x).backward() # 整数梯度加浮点梯度，不能写回整数数组
+        self.assertEqual(x.grad.dtype, np.float64)
+        self.assertTrue(np.allclose(x.grad, 6 + np.exp(3)))
+
+    def test_readonly_grad(self):
+        # 0 维输出的初始梯度是共享的只读数组，之后在它上面累加时不能原地写入
+        one = step09._ONE_CACHE[np.dtype(np.float64)]
+        x = Variable(np.array(0.5))
+        y = exp(x)
+        y.backward()
+        self.assertIs(y.grad, one)
+        self.assertFalse(y.grad.flags.writeable)
+        square(y).backward(retain_grad=True)
+        self.assertTrue(np.allclose(y.grad, 1 + 2 * y.data))
+        z = Variable(np.array(1.0))
+        z.backward() # 叶子变量自身的初始梯度同样来自缓存
+        square(z).backward()
+        self.assertEqual(z.grad, 3.0)
+        self.assertEqual(one, 1.0)
+
+# 测试记忆化：命中、LRU 淘汰、写入梯度或替换 data 后失效，以及与 no_grad 的配合
+class MemoizeTest(unittest.TestCase):
+    def setUp(self):
+        Function.memoize = True
+        Function._cache.clear()
+
+    def tearDown(self):
+        Function.memoize = False
+        Function._cache_size = 1024
+        Function._cache.clear()
+
+    def test_hit(self):
+        x = Variable(np.array(2.0))
+        y = square(x)
+        self.assertIs(square(x), y)
+        self.assertIsNot(exp(x), y) # 不同类型的函数不共用缓存
+
+    def test_parametrized(self):
+        class Pow(Function):
+            __slots__ = ('c',)
+
+            def __init__(self, c):
+                self.c = c
+
+            def forward(self, x):
+                return x ** self.c
+
+        class KeyedPow(Pow):
+            __slots__ = ()
+
+            def _memo_key(self):
+                return (self.c,)
+
+        x = Variable(np.array(2.0))
+        # 未提供 _memo_key 的函数不参与记忆化
+        self.assertEqual(Pow(2)(x).data, 4.0)
+        self.assertEqual(Pow(3)(x).data, 8.0)
+        # 参数不同的实例不能共用缓存，参数相同时命中
+        y2 = KeyedPow(2)(x)
+        y3 = KeyedPow(3)(x)
+        self.assertEqual(y2.data, 4.0)
+        self.assertEqual(y3.data, 8.0)
+        self.assertIs(KeyedPow(2)(x), y2)
+
+    def test_invalidate(self):
+        x = Variable(np.array(2.0))
+        y = square(x)
+        y.backward() # 写入 x.grad 后 x._version 改变
+        y1 = square(x)
+        self.assertIsNot(y1, y)
+        x.data = np.array(3.0) # 替换 data
+        y2 = square(x)
+        self.assertIsNot(y2, y1)
+        self.assertEqual(y2.data, 9.0)
+
+    def test_lru(self):
+        Function._cache_size = 2
+        x0, x1, x2 = (Variable(np.array(v)) for v in (1.0, 2.0, 3.0))
+        y0 = square(x0)
+        y1 = square(x1)
+        self.assertIs(square(x0), y0) # 命中后 x0 的条目变为最近使用
+        square(x2) # 超出容量，淘汰最久未使用的 x1
+        self.assertIs(square(x0), y0)
+        self.assertIsNot(square(x1), y1)
+
+    def test_no_grad(self):
+        x = Variable(np.array(2.0))
+        with no_grad():
+            y0 = square(x)
+        y1 = square(x) # no_grad 下的输出没有创造者，不会被放入缓存
+        self.assertIsNot(y1, y0)
+        self.assertIs(y1.creator.input, x)
+        with no_grad():
+            y2 = square(x) # no_grad 下也不读取缓存
+        self.assertIsNot(y2, y1)
+        self.assertIsNone(y2.creator)
+
+# 测试 numba 内核：临时调低 _NUMBA_MIN_SIZE，使小数组也走内核，结果应与 NumPy 表达式一致
+class NumbaTest(unittest.TestCase):
+    def setUp(self):
+        self.min_size = step09._NUMBA_MIN_SIZE
+        step09._NUMBA_MIN_SIZE = 1
+
+    def tearDown(self):
+        step09._NUMBA_MIN_SIZE = self.min_size
+
+    @unittest.skipIf(step09.njit is None, "numba is not installed")
+    def test_kernels(self):
+        for dtype in (np.float32, np.float64):
+            data = np.random.rand(4, 6).astype(dtype)
+            for x_data in (data, data[:, ::2]): # 包括非连续的输入
+                gy = np.random.rand(*x_data.shape).astype(dtype)
+                x = Variable(x_data)
+                y = square(x)
+                self.assertEqual(y.data.dtype, dtype)
+                self.assertTrue(np.allclose(y.data, x_data * x_data))
+                self.assertTrue(np.allclose(y.creator.backward(gy), 2 * x_data * gy))
+                z = exp(x)
+                self.assertTrue(np.allclose(z.creator.backward(gy), z.data * gy))
+
+    def test_use_numba(self):
+        x = np.ones(8)
+        self.assertTrue(step09._use_numba(x, np.ones(8)))
+        self.assertFalse(step09._use_numba(x, np.ones(1))) # 需要广播
+        self.assertFalse(step09._use_numba(x, np.ones(8, dtype=np.float32))) # dtype 不同
+        self.assertFalse(step09._use_numba(x, 1.0)) # 不是 ndarray
+        self.assertFalse(step09._use_numba(np.ones(8, dtype=np.int64)))
+        self.assertFalse(step09._use_numba(np.ones(8, dtype=np.float16)))
+
+# 测试 Cython 内核：需先执行 python setup.py build_ext --inplace，结果应与 x * x 一致
+@unittest.skipIf(step09.fast_square is None, "the Cython kernel is not built")
+class CythonTest(unittest.TestCase):
+    def test_fast_square(self):
+        x = np.array(3.0)
+        y = step09.fast_square(x)
+        self.assertEqual(y.shape, ())
+        self.assertEqual(y, x * x)
+
+        x = np.random.rand(2 * step09._CYTHON_MIN_SIZE)[::2] # 非连续，元素个数达到 _CYTHON_MIN_SIZE
+        self.assertTrue(np.array_equal(step09.fast_square(x), x * x))
+        self.assertTrue(np.array_equal(square(Variable(x)).data, x * x)) # Square.forward 走 fast_square 分支
+
+# 测试默认浮点类型：设为 float32 后数据和梯度都应为 float32
+class DefaultDtypeTest(unittest.TestCase):
+    def setUp(self):
+        step09.DEFAULT_DTYPE = np.float32
+
+    def tearDown(self):
+        step09.DEFAULT_DTYPE = None
+
+    def test_float32(self):
+        x = Variable(np.array(2.0))
+        y = square(exp(x))
+        y.backward()
+        self.assertEqual(x.data.dtype, np.float32)
+        self.assertEqual(y.data.dtype, np.float32)
+        self.assertEqual(x.grad.dtype, np.float32)
+        self.assertTrue(np.allclose(y.data, np.exp(4), atol=1e-5))
+        self.assertTrue(np.allclose(x.grad, 2 * np.exp(4), rtol=1e-5, atol=1e-5))
+
+    def test_compile_grad(self):
+        run = compile_grad(lambda x: square(exp(x)), Variable(np.array(2.0)))
+        y, gx = run(np.array(2.0)) # 输入按 DEFAULT_DTYPE 转换，与直接调用一致
+        self.assertEqual(y.dtype, np.float32)
+        self.assertEqual(gx.dtype, np.float32)
+        self.assertTrue(np.allclose(gx, 2 * np.exp(4), rtol=1e-5, atol=1e-5))
+
+# 测试 step11 的多输入反向传播：按 generation 出堆，共享的中间变量的梯度累加完毕后才继续传播
+class Step11BackwardTest(unittest.TestCase):
+    def test_add(self):
+        x0 = step11.Variable(np.array(2.0))
+        x1 = step11.Variable(np.array(3.0))
+        y, = step11.Add()([x0, x1])
+        y.backward()
+        self.assertEqual(y.data, 5.0)
+        self.assertEqual(x0.grad, 1.0)
+        self.assertEqual(x1.grad, 1.0)
+
+    def test_same_input(self):
+        # Add 对两个输入返回同一个 gy，x.grad 不能与 y.grad 共用数组
+        x = step11.Variable(np.array(3.0))
+        y, = step11.Add()([x, x])
+        y.backward()
+        self.assertEqual(x.grad, 2.0)
+        self.assertEqual(y.grad, 1.0)
+
+    def test_diamond(self):
+        # y = exp(a) + a^2, a = x^2
+        x = step11.Variable(np.array(0.5))
+        a, = step11.Square()([x])
+        b, = step11.Exp()([a])
+        c, = step11.Square()([a])
+        y, = step11.Add()([b, c])
+        y.backward(retain_grad=True)
+        a_data = x.data ** 2
+        expected = (np.exp(a_data) + 2 * a_data) * 2 * x.data
+        self.assertTrue(np.allclose(x.grad, expected))
+        self.assertTrue(np.allclose(a.grad, np.exp(a_data) + 2 * a_data))
+
+    def test_separate_backward(self):
+        x = step11.Variable(np.array(0.5))
+        a, = step11.Exp()([x])
+        b, = step11.Square()([a])
+        c, = step11.Exp()([a])
+        b.backward()
+        c.backward()
+        e = np.exp(x.data)
+        self.assertTrue(np.allclose(x.grad, 2 * e * e + np.exp(e) * e))
+        self.assertIsNone(a.grad)
+
+    def test_int_to_float(self):
+        x = step11.Variable(np.array([3]))
+        step11.Square()([x])[0].backward()
+        step11.Exp()([x])[0].backward()
+        self.assertEqual(x.grad.dtype, np.float64)
+        self.assertTrue(np.allclose(x.grad, 6 + np.exp(3)))
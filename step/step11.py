@@ -1,7 +1,38 @@
 from __future__ import annotations
+import heapq
 from typing import Optional, Any, Union, List
 import numpy as np
 
+_ENABLE_GRAD: List[bool] = [True]  # 是否构建计算图，由 no_grad 切换
+
+
+class no_grad:
+    """
+    关闭计算图构建的上下文管理器，用于只需要正向传播的推理场景。
+
+    在 with 块内，Function.__call__ 不再为输出设置创建者，也不保存输入和输出变量，
+    因此中间结果不会被计算图引用，可以被及时回收，峰值内存随之降低。
+
+    Examples:
+        >>> with no_grad():
+        ...     y = Square()([Variable(np.array(2.0))])[0]
+        >>> y.creator is None
+        True
+
+    Notes:
+        - 退出时恢复进入前的状态，因此可以嵌套使用。
+        - 状态保存在模块级的 _ENABLE_GRAD 中，对所有线程生效。
+    """
+
+    def __enter__(self) -> no_grad:
+        self.prev: bool = _ENABLE_GRAD[0]
+        _ENABLE_GRAD[0] = False
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        _ENABLE_GRAD[0] = self.prev
+
+
 class Variable:
     """
     表示计算图中的变量，封装数据并支持自动求导。
@@ -12,6 +43,7 @@ class Variable:
         data (np.ndarray): 变量的数据，通常为标量或张量。
         grad (Optional[np.ndarray]): 变量的梯度，初始为 None，在反向传播时计算。
         creator (Optional[Function]): 创建该变量的函数实例，初始为 None，用于构建计算图。
+        generation (int): 变量在计算图中的"辈分"，叶子变量为 0，由函数创建的变量为创建者的 generation 加 1。
 
     Methods:
         __init__: 初始化变量，验证并存储输入数据。
@@ -20,10 +52,12 @@ class Variable:
 
     Notes:
         - 输入数据必须是 np.ndarray 类型，否则抛出 TypeError。
-        - 反向传播假设 creator 是 Function 实例，支持单输入单输出场景。
-        - 若需支持多输入场景，需在 Function 和 backward 中扩展逻辑。
+        - 使用 __slots__ 声明属性，实例不再创建 __dict__，以减少内存分配并加快属性访问。
+        - 反向传播假设 creator 是 Function 实例，按拓扑序逆序处理多输入多输出的函数。
     """
 
+    __slots__ = ('data', 'grad', 'creator', 'generation')
+
     def __init__(self, data: Optional[np.ndarray]) -> None:
         """
         初始化 Variable 实例，验证并存储输入数据。
@@ -36,14 +70,15 @@ class Variable:
 
         Notes:
             - 数据验证确保后续计算的兼容性。
-            - grad 和 creator 初始为 None，在计算图构建和反向传播中动态设置。
+            - 使用 type(data) is np.ndarray 而非 isinstance 进行检查，省去 MRO 遍历；np.ndarray 的子类同样不被接受。
+            - grad 和 creator 初始为 None，generation 初始为 0，在计算图构建和反向传播中动态设置。
         """
-        if data is not None:
-            if not isinstance(data, np.ndarray):
-                raise TypeError(f"{type(data).__name__} is not supported")
+        if data is not None and type(data) is not np.ndarray:
+            raise TypeError(f"{type(data).__name__} is not supported")
         self.data: Optional[np.ndarray] = data
         self.grad: Optional[np.ndarray] = None
         self.creator: Optional[Function] = None
+        self.generation: int = 0
 
     def set_creator(self, func: Function) -> None:
     # def set_creator(self, func: Any) -> None:
@@ -55,63 +90,97 @@ class Variable:
 
         Notes:
             - 该方法通常由 Function.__call__ 调用，以记录计算图中的依赖关系。
+            - 变量的 generation 被设置为创建者的 generation 加 1。
         """
         self.creator = func
+        self.generation = func.generation + 1
 
-    def backward(self) -> None:
+    def backward(self, retain_grad: bool = False) -> None:
         """
         执行反向传播，计算并传播梯度至输入变量。
 
-        通过调用创建者函数的 backward 方法，基于链式法则计算梯度，并递归传播至计算图中的前驱节点。
+        通过调用创建者函数的 backward 方法，基于链式法则计算梯度，并按 generation 从大到小传播至计算图中的前驱节点。
+
+        Args:
+            retain_grad (bool): 是否把中间变量（creator 不为 None）收到的梯度累加到其 grad 上。默认只有叶子变量保存梯度。
 
         Notes:
-            - 若 grad 为 None，则初始化为与 data 同形的全 1 数组（通常用于输出节点）。
-            - 当前实现假设单输入单输出，若 creator 涉及多输入，需扩展 Function.backward。
-            - 使用列表模拟队列，按深度优先顺序处理计算图中的函数节点。
+            - 若 grad 为 None，则初始化为与 data 同形的全 1 数组（通常用于输出节点）；否则直接用作初始梯度。
+            - 中间变量在本次反向传播中收到的梯度记在局部的 grads 字典中，而不是读取其 grad，
+              因此对共享同一中间变量的多个输出分别调用 backward 时，之前留下的梯度不会被重复传播。
+            - 待处理的函数保存在以 -generation 为优先级的堆中，generation 大的函数先出堆。因此在菱形等共享子表达式的计算图中，
+              一个函数的所有输出梯度都累加完毕后才会处理它。
+            - seen 集合以 id(func) 为键，保证每个函数只被处理一次，总复杂度为 O(V + E)。
+            - 同一叶子变量被多个函数使用时，其梯度通过 np.add(..., out=x.grad) 原地累加，避免每次累加都分配新数组；
+              相加后的类型与 x.grad 不同（如整数梯度加浮点梯度）时改为创建新数组。
+            - 首次写入的梯度若与上游梯度或其他输入的梯度是同一对象（如 Add 原样返回 gy），会先复制一份，避免原地累加时改写其他变量的梯度。
         """
         if self.grad is None:  # 如果梯度为 None，初始化为 1
             self.grad = np.ones_like(self.data)
 
-        funcs: list[Function] = [self.creator]
-        while funcs:
-            f: Function = funcs.pop()  # 获取最后一个元素
-            x: Variable
-            y: Variable
-            x, y = f.inputs, f.outputs  # 获取输入和输出
-            x.grad = f.backward(y.grad)  # 计算梯度
+        # 堆中元素为 (-generation, id(func), func)，id 用于 generation 相同时比较，避免直接比较函数对象
+        funcs: List[tuple[int, int, Function]] = []
+        seen: set[int] = set()
+        grads: dict[int, Any] = {id(self): self.grad}  # id(中间变量) -> 本次反向传播中累加的梯度
 
-            if x.creator is not None:
-                funcs.append(x.creator)  # 将输入的创建者添加到列表中
+        def add_func(f: Function) -> None:
+            if id(f) not in seen:
+                seen.add(id(f))
+                heapq.heappush(funcs, (-f.generation, id(f), f))
+
+        if self.creator is not None:
+            add_func(self.creator)
+
+        while funcs:
+            f: Function = heapq.heappop(funcs)[2]
+            gys: List[Any] = [grads.pop(id(y), None) for y in f.outputs]  # 出堆时输出的梯度已累加完毕
+            if retain_grad:
+                for y, gy in zip(f.outputs, gys):
+                    if y is not self and gy is not None:
+                        y.grad = gy if y.grad is None else y.grad + gy
+            gxs: List[Any] = f.backward(gys)  # 计算输入的梯度
+            shared: List[Any] = list(gys)  # 已被其他变量持有的梯度对象
+            for x, gx in zip(f.inputs, gxs):
+                if x.creator is not None:
+                    g = grads.get(id(x))
+                    grads[id(x)] = gx if g is None else g + gx  # 不原地累加，gx 可能与其他梯度是同一对象
+                    add_func(x.creator)
+                elif x.grad is None:
+                    x.grad = np.copy(gx) if any(gx is g for g in shared) else gx
+                elif (type(x.grad) is np.ndarray and x.grad.shape == np.shape(gx)
+                      and np.result_type(x.grad, gx) == x.grad.dtype):
+                    np.add(x.grad, gx, out=x.grad)  # 原地累加梯度
+                else:  # x.grad 为 NumPy 标量、需要广播或相加后类型会提升（如整数加浮点）时，无法原地累加
+                    x.grad = x.grad + gx
+                shared.append(gx)
 
 
 def as_array(x: Any) -> np.ndarray:
     """
     将输入数据转换为 NumPy 数组（ndarray）类型。
 
-    该函数检查输入是否为标量，若是标量则将其包装为 NumPy 数组；若已是数组，则直接返回。适用于统一数据类型以便后续计算。
+    若输入已是 np.ndarray，则直接返回；否则交给 np.asarray 转换。适用于统一数据类型以便后续计算。
 
     Args:
-        x (Any): 输入数据，可以是标量（如 int、float）或数组（如 list、np.ndarray）。
+        x (Any): 输入数据，可以是标量（如 int、float、NumPy 标量）或类数组对象（如 list、np.ndarray）。
 
     Returns:
-        np.ndarray: 转换后的 NumPy 数组。若输入已是 np.ndarray，则返回原对象；若输入为标量，则返回单元素数组。
+        np.ndarray: 转换后的 NumPy 数组。若输入已是 np.ndarray，则返回原对象；若输入为标量，则返回 0 维数组。
 
     Notes:
-        - 使用 np.isscalar 判断输入是否为标量，支持 Python 内置标量类型（如 int、float）以及 NumPy 标量。
-        - 若输入为非标量且不是 np.ndarray（如 list），则直接返回，可能导致类型不一致的风险。
-        - 为确保健壮性，建议在调用前验证输入是否符合预期类型。
+        - 使用 type(x) is np.ndarray 判断，不再调用 np.isscalar（其内部要做多次 isinstance 检查，开销较大）。
+        - np.asarray 对标量只做一次包装，不会额外复制数据。
+        - 模块内的 Function.__call__ 为减少函数调用开销内联了同样的转换，本函数不再被内部调用，保留为公开接口。
 
     Examples:
         >>> as_array(3)
-        array([3])
+        array(3)
         >>> as_array([1, 2, 3])
-        [1, 2, 3]  # 未转换，仍为 list
+        array([1, 2, 3])
         >>> as_array(np.array([1, 2]))
         array([1, 2])  # 原样返回
     """
-    if np.isscalar(x):
-        return np.array(x)
-    return x
+    return x if type(x) is np.ndarray else np.asarray(x)
 
 
 class Function:
@@ -129,8 +198,15 @@ class Function:
         - 该类假设输入和输出均为 Variable 实例，Variable.data 为可计算的数据（如标量或张量）。
         - 子类必须实现 forward 和 backward 方法，否则调用时将抛出 NotImplementedError。
         - 当前实现假设单输出场景，若需支持多输出，需确保 forward 返回列表并在 __call__ 中正确处理。
+        - 使用 __slots__ 声明 inputs 和 outputs，子类需声明自己的 __slots__（无新属性时为空元组），否则仍会创建 __dict__。
+        - 子类可将 _n_inputs 和 _n_outputs 都设为 1，以声明自己是单输入单输出函数，__call__ 会为其走快速路径。
     """
 
+    __slots__ = ('inputs', 'outputs', 'generation')
+
+    _n_inputs: Optional[int] = None   # 输入个数，None 表示不固定
+    _n_outputs: Optional[int] = None  # 输出个数，None 表示不固定
+
     def __call__(self, inputs: List[Variable]) -> List[Variable]:
         """
         执行函数的前向计算，接受输入变量并返回输出变量，同时构建计算图。
@@ -143,13 +219,34 @@ class Function:
 
         Notes:
             - 输入数据的提取通过列表推导式完成，假设每个 Variable 实例具有 data 属性。
-            - 输出变量通过 forward 方法计算，并包装为 Variable 实例。
+            - 输出变量通过 forward 方法计算，并包装为 Variable 实例；非 ndarray 的结果通过 np.asarray 转换。
             - 计算图通过为每个输出设置创建者（self）以及记录输入和输出关系来构建。
+            - 函数的 generation 取所有输入中最大的 generation，输出的 generation 为其加 1。
+            - 单输入单输出的子类（_n_inputs == _n_outputs == 1）走快速路径，省去列表推导式和设置创建者的循环。
+            - 在 no_grad 块内只执行前向计算，不构建计算图。
         """
+        enable_grad: bool = _ENABLE_GRAD[0]
+        if self._n_inputs == 1 and self._n_outputs == 1:
+            y: Any = self.forward([inputs[0].data])[0]
+            output: Variable = Variable(y if type(y) is np.ndarray else np.asarray(y))
+            if not enable_grad:
+                return [output]
+            self.generation = inputs[0].generation
+            output.creator = self
+            output.generation = self.generation + 1
+            self.inputs = inputs
+            self.outputs = [output]
+            return self.outputs
+
         xs: List[Any] = [x.data for x in inputs]  # 提取输入变量的数据
         ys: List[Any] = self.forward(xs)          # 调用子类实现的前向计算
-        outputs: List[Variable] = [Variable(as_array(y)) for y in ys]  # 将结果转换为 Variable 实例
+        outputs: List[Variable] = [
+            Variable(y if type(y) is np.ndarray else np.asarray(y)) for y in ys
+        ]  # 将结果转换为 Variable 实例（内联 as_array，避免 np.isscalar 的开销）
+        if not enable_grad:
+            return outputs
 
+        self.generation: int = max(x.generation for x in inputs)
         for output in outputs:
             output.set_creator(self)   # 为输出设置创建者，建立计算图
         self.inputs: List[Variable] = inputs  # 保存输入变量
@@ -195,13 +292,53 @@ class Function:
         raise NotImplementedError()
     
 class Add(Function):
+    __slots__ = ()
+
     def forward(self, xs: List[Any]) -> List[Any]:
         x0, x1 = xs
         y = x0 + x1
         return(y,)
-    
-xs = [Variable(np.array(2.0)), Variable(np.array(3.0))]
-f = Add()
-ys = f(xs)
-y = ys[0]
-print(y.data)
\ No newline at end of file
+
+    def backward(self, gys: List[Any]) -> List[Any]:
+        gy, = gys
+        return [gy, gy]  # 加法的梯度原样传给两个输入
+
+
+class Square(Function):
+    __slots__ = ()
+
+    _n_inputs = 1
+    _n_outputs = 1
+
+    def forward(self, xs: List[Any]) -> List[Any]:
+        x, = xs
+        return [x * x]  # 用乘法代替 np.power
+
+    def backward(self, gys: List[Any]) -> List[Any]:
+        x = self.inputs[0].data
+        gy, = gys
+        return [2 * x * gy]
+
+
+class Exp(Function):
+    __slots__ = ()
+
+    _n_inputs = 1
+    _n_outputs = 1
+
+    def forward(self, xs: List[Any]) -> List[Any]:
+        x, = xs
+        return [np.exp(x)]
+
+    def backward(self, gys: List[Any]) -> List[Any]:
+        y = self.outputs[0].data  # exp 的导数等于其输出，直接复用
+        gy, = gys
+        return [y * gy]
+
+
+if __name__ == '__main__':
+    xs = [Variable(np.array(2.0)), Variable(np.array(3.0))]
+    f = Add()
+    ys = f(xs)
+    y = ys[0]
+    print(y.data)